@@ -1,10 +1,23 @@
 from mcp.server import FastMCP
+from mcp.server.fastmcp import Context
 import asyncio
 from genie.testbed import load
 from genie.libs.parser.utils import get_parser
 from genie.metaparser.util.exceptions import SchemaEmptyParserError
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
 import os
+import time
+from typing import Optional
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger("network_mcp")
 
 # Create an instance of the MCP server
 mcp = FastMCP("hello-world-server")
@@ -18,38 +31,179 @@ mcp.settings.port = 8000       # Specify the port
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TESTBED_PATH = os.path.join(BASE_DIR, "etc", "testbed.yaml")
 
+# CLI commands issued by the tools
+SHOW_VERSION = "show version"
+SHOW_LLDP = "show lldp neighbors detail"
+SHOW_CDP = "show cdp neighbors detail"
+
+# Worker threads for blocking pyATS calls: up to MAX_INFLIGHT_PARSES parses,
+# plus connect, disconnect and is_connected calls, which are not bounded by it
+THREAD_POOL_SIZE = int(os.getenv("MCP_THREAD_POOL", "64"))
+
+# Maximum number of blocking parse/execute calls running at once; further
+# requests wait on the event loop instead of queueing in the thread pool
+MAX_INFLIGHT_PARSES = int(os.getenv("MCP_MAX_INFLIGHT_PARSES", "16"))
+
+# Seconds a parsed command output is reused before the device is queried again
+PARSE_CACHE_TTL = int(os.getenv("MCP_PARSE_CACHE_TTL", "30"))
+
+# Seconds between health checks of cached connections, and seconds a
+# connection may sit idle before it is closed
+REAPER_INTERVAL = int(os.getenv("MCP_REAPER_INTERVAL", "60"))
+CONTROL_PERSIST = int(os.getenv("MCP_CONTROL_PERSIST", "600"))
+
 
 
 # Load the pyATS testbed
 testbed = load(TESTBED_PATH)
 
+
+def _build_device_catalog(tb):
+    """Build the static device metadata served by list_devices."""
+    catalog = {}
+    for device in tb.devices.values():
+        cli = getattr(device.connections, "cli", None)
+        catalog[device.name] = {
+            "os": device.os or "unknown",
+            "type": device.type or "unknown",
+            "function": getattr(getattr(device, "custom", None), "function", "unknown"),
+            "management_ip": str(getattr(cli, "ip", "unknown")) if cli else "unknown"
+        }
+    return catalog
+
+
+# Testbed metadata is static, so build it once instead of on every call
+_DEVICE_CATALOG = _build_device_catalog(testbed)
+
 class DeviceConnectionManager:
     def __init__(self):
         self._connections = {}
-        self._connection_locks = {}
+        self._connection_locks: dict[str, asyncio.Lock] = {}
+        self._connect_locks: dict[str, asyncio.Lock] = {}
+        self._last_used: dict[str, float] = {}
+
+    def lock_for(self, device_name: str) -> asyncio.Lock:
+        """Return the lock serializing CLI access to a device's shared session."""
+        return self._connection_locks.setdefault(device_name, asyncio.Lock())
+
+    def _connect_lock_for(self, device_name: str) -> asyncio.Lock:
+        return self._connect_locks.setdefault(device_name, asyncio.Lock())
     
-    async def get_connection(self, device_name: str):
-        if device_name not in self._connections:
-            device = testbed.devices[device_name]
-            await run_in_thread(device.connect)
-            self._connections[device_name] = device
-            print(f"[DEBUG] New connection established for {device_name}")
+    async def get_connection(self, device_name: str, device=None):
+        connect_lock = self._connect_lock_for(device_name)
+        # The lock is also held while cleanup_connection tears a session down,
+        # so don't take the fast path while it is busy
+        if device_name not in self._connections or connect_lock.locked():
+            # Hold the connect lock across the handshake so concurrent callers
+            # wait for and reuse the first connection instead of opening their own
+            async with connect_lock:
+                if device_name not in self._connections:
+                    if device is None:
+                        device = testbed.devices[device_name]
+                    await asyncio.to_thread(device.connect)
+                    self._connections[device_name] = device
+                    log.debug("New connection established for %s", device_name)
+        self._last_used[device_name] = time.monotonic()
         return self._connections[device_name]
     
     async def cleanup_connection(self, device_name: str):
-        if device_name in self._connections:
-            await run_in_thread(self._connections[device_name].disconnect)
-            del self._connections[device_name]
+        # Hold the connect lock too, so a concurrent get_connection waits for the
+        # teardown to finish instead of reconnecting the device mid-disconnect
+        async with self._connect_lock_for(device_name), self.lock_for(device_name):
+            device = self._connections.get(device_name)
+            if device is None:
+                return
+            try:
+                await asyncio.to_thread(device.disconnect)
+            finally:
+                self._connections.pop(device_name, None)
+                self._last_used.pop(device_name, None)
+
+    async def cleanup_replaced(self, tb):
+        """Close cached connections whose device is no longer the one in tb."""
+        for device_name, device in list(self._connections.items()):
+            if tb.devices.get(device_name) is not device:
+                try:
+                    await self.cleanup_connection(device_name)
+                except Exception as e:
+                    log.warning("Disconnect of %s failed: %s", device_name, e)
+
+    async def reaper(self, interval: int = REAPER_INTERVAL):
+        """Periodically close cached connections that are dead or idle too long."""
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for device_name, device in list(self._connections.items()):
+                if now - self._last_used.get(device_name, now) > CONTROL_PERSIST:
+                    reason = "idle timeout"
+                else:
+                    try:
+                        async with self.lock_for(device_name):
+                            alive = await asyncio.to_thread(device.is_connected)
+                    except Exception:
+                        alive = False
+                    if alive:
+                        continue
+                    reason = "connection lost"
+
+                try:
+                    await self.cleanup_connection(device_name)
+                except Exception as e:
+                    log.warning("Disconnect of %s failed: %s", device_name, e)
+                log.debug("Closed connection to %s (%s)", device_name, reason)
 
 # Global connection manager
 connection_manager = DeviceConnectionManager()
 
+# Recently parsed outputs keyed on (device_name, command)
+_PARSE_CACHE = TTLCache(maxsize=1024, ttl=PARSE_CACHE_TTL)
+_parse_locks: dict[tuple[str, str], asyncio.Lock] = {}
+_parse_semaphore = None
+
+
+def parse_slots() -> asyncio.Semaphore:
+    """Return the semaphore bounding concurrent parse/execute calls."""
+    global _parse_semaphore
+    # Created on first use so it binds to the running event loop
+    if _parse_semaphore is None:
+        _parse_semaphore = asyncio.Semaphore(MAX_INFLIGHT_PARSES)
+    return _parse_semaphore
+
+
+async def cached_parse(device_name: str, device, command: str):
+    """Parse a command on a device, reusing a recent result when available."""
+    key = (device_name, command)
+    parsed = _PARSE_CACHE.get(key)
+    if parsed is not None:
+        return parsed
+
+    # Concurrent misses for the same command wait here and reuse the first result
+    async with _parse_locks.setdefault(key, asyncio.Lock()):
+        parsed = _PARSE_CACHE.get(key)
+        if parsed is None:
+            async with connection_manager.lock_for(device_name), parse_slots():
+                parsed = await asyncio.to_thread(device.parse, command)
+            _PARSE_CACHE[key] = parsed
+    return parsed
+
 
-# Asynchronous Wrapper for Blocking Calls
-def run_in_thread(func, *args, **kwargs):
-    """Run synchronous function in a thread."""
-    loop = asyncio.get_event_loop()
-    return loop.run_in_executor(None, func, *args, **kwargs)
+def _dumps(obj) -> str:
+    """Serialize to JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj)
+
+
+# Shared default for missing branches of parser output -- never mutate it
+_EMPTY = {}
+
+
+def _iter_lldp(lldp_output):
+    """Yield (local_interface, neighbor_info) pairs from parsed LLDP output."""
+    for local_intf, intf_data in (lldp_output.get("interfaces") or _EMPTY).items():
+        for port_data in (intf_data.get("port_id") or _EMPTY).values():
+            for neighbor_info in (port_data.get("neighbors") or _EMPTY).values():
+                yield local_intf, neighbor_info
 
 
 @mcp.tool()
@@ -76,20 +230,32 @@ async def list_devices() -> dict:
         }
     """
 
-    try:
-        device_list = {}
-        for device in testbed.devices.values():
+    return {"devices": _DEVICE_CATALOG}
 
-            device_list[device.name]= {
-                "os": device.os or "unknown", 
-                "type": device.type  or "unknown",
-                "function": getattr(device.custom, "function", "unknown"),
-                "management_ip": str(getattr(device.connections.cli, "ip", "unknown"))
-                }
+@mcp.tool()
+async def reload_testbed() -> dict:
+    """
+    Reload the testbed YAML file and rebuild the device catalog.
+
+    Call this after editing the testbed file on the server so that
+    list_devices and the other tools see the new device definitions.
+    Open device connections are closed, and the next call to a device
+    reconnects using its new definition.
 
-        return {"devices": device_list}
+    Returns:
+        dict: {"success": true, "total_devices": <number of devices>}
+    """
+    global testbed, _DEVICE_CATALOG
+
+    try:
+        new_testbed = await asyncio.to_thread(load, TESTBED_PATH)
+        catalog = _build_device_catalog(new_testbed)
+        testbed, _DEVICE_CATALOG = new_testbed, catalog
+        _PARSE_CACHE.clear()
+        await connection_manager.cleanup_replaced(new_testbed)
+        return {"success": True, "total_devices": len(_DEVICE_CATALOG)}
     except Exception as e:
-        return {"error": f"Failed to list devices: {str(e)}"}
+        return {"success": False, "error": f"Failed to reload testbed: {str(e)}"}
 
 @mcp.tool()
 async def show_version(device_name: str) -> dict:
@@ -103,17 +269,19 @@ async def show_version(device_name: str) -> dict:
         dict: Parsed or raw output of 'show version' command.
     """
     try:
-        if device_name not in testbed.devices:
+        device = testbed.devices.get(device_name)
+        if device is None:
             return {"error": f"Device not found: {device_name}"}
-        
-        device = await connection_manager.get_connection(device_name)
-        print(f"[DEBUG] Connected to {device_name}")
+
+        device = await connection_manager.get_connection(device_name, device)
+        log.debug("Connected to %s", device_name)
 
         try:
-            parsed_output = await run_in_thread(device.parse, "show version")
+            parsed_output = await cached_parse(device_name, device, SHOW_VERSION)
             return {"success": True, "data": parsed_output}
         except SchemaEmptyParserError:
-            raw_output = await run_in_thread(device.execute, "show version")
+            async with connection_manager.lock_for(device_name), parse_slots():
+                raw_output = await asyncio.to_thread(device.execute, SHOW_VERSION)
             return {
                 "success": True,
                 "data": {"raw_output": raw_output},
@@ -154,25 +322,23 @@ async def discover_neighbors_lldp(device_name: str = "") -> dict:
             "device_name": "rtr1"
         }
     """
-    if device_name not in testbed.devices:
+    device = testbed.devices.get(device_name)
+    if device is None:
         return {"success": False, "error": f"Device not found: {device_name}"}
 
     try:
-        device = await connection_manager.get_connection(device_name)
-        lldp_output = await run_in_thread(device.parse, "show lldp neighbors detail")
-
-        neighbors = []
-        if "interfaces" in lldp_output:
-            for local_intf, intf_data in lldp_output["interfaces"].items():
-                port_id_dict = intf_data.get("port_id", {})
-                for _, port_data in port_id_dict.items():
-                    for _, neighbor_info in port_data.get("neighbors", {}).items():
-                        neighbors.append({
-                            "protocol": "lldp",
-                            "local_interface": local_intf,
-                            "remote_device": neighbor_info.get("system_name") or neighbor_info.get("neighbor_id"),
-                            "remote_interface": neighbor_info.get("port_id") or neighbor_info.get("port_description")
-                        })
+        device = await connection_manager.get_connection(device_name, device)
+        lldp_output = await cached_parse(device_name, device, SHOW_LLDP)
+
+        neighbors = [
+            {
+                "protocol": "lldp",
+                "local_interface": local_intf,
+                "remote_device": neighbor_info.get("system_name") or neighbor_info.get("neighbor_id"),
+                "remote_interface": neighbor_info.get("port_id") or neighbor_info.get("port_description")
+            }
+            for local_intf, neighbor_info in _iter_lldp(lldp_output)
+        ]
 
         return {
             "success": True,
@@ -215,12 +381,13 @@ async def discover_neighbors_cdp(device_name: str = "") -> dict:
             "device_name": "rtr1"
         }
     """
-    if device_name not in testbed.devices:
+    device = testbed.devices.get(device_name)
+    if device is None:
         return {"success": False, "error": f"Device not found: {device_name}"}
 
     try:
-        device = await connection_manager.get_connection(device_name)
-        cdp_output = await run_in_thread(device.parse, "show cdp neighbors detail")
+        device = await connection_manager.get_connection(device_name, device)
+        cdp_output = await cached_parse(device_name, device, SHOW_CDP)
 
         neighbors = []
         if "index" in cdp_output:
@@ -246,10 +413,12 @@ async def discover_neighbors_cdp(device_name: str = "") -> dict:
 
 
 @mcp.tool()
-async def discover_neighbors_combined(device_name: str = "") -> dict:
+async def discover_neighbors_combined(device_name: str = "", ctx: Optional[Context] = None) -> dict:
     """
     🎯 Purpose:
         Discover all neighboring network devices using both LLDP and CDP, with deduplication.
+        LLDP and CDP results are each sent as an info log notification as soon as
+        they are parsed, ahead of the final deduplicated result.
 
     📥 Parameters:
         device_name (str): Name of the device in the pyATS testbed.
@@ -277,70 +446,84 @@ async def discover_neighbors_combined(device_name: str = "") -> dict:
             "device_name": "rtr1"
         }
     """
-    if device_name not in testbed.devices:
+    device = testbed.devices.get(device_name)
+    if device is None:
         return {"success": False, "error": f"Device not found: {device_name}"}
 
     try:
-        device = await connection_manager.get_connection(device_name)
-
-        # Run both discovery commands
-        lldp_neighbors = []
-        cdp_neighbors = []
+        device = await connection_manager.get_connection(device_name, device)
+        completed = 0
+
+        # Stream each protocol's neighbors to the client as soon as they are parsed
+        async def _report(protocol, neighbors):
+            nonlocal completed
+            if ctx is None:
+                return
+            completed += 1
+            try:
+                await ctx.report_progress(completed, 2)
+                await ctx.info(_dumps({"protocol": protocol, "partial": neighbors}))
+            except Exception as e:
+                log.debug("Could not send partial %s result for %s: %s", protocol, device_name, e)
 
         # LLDP parsing
-        try:
-            lldp_output = await run_in_thread(device.parse, "show lldp neighbors detail")
-            if "interfaces" in lldp_output:
-                for local_intf, intf_data in lldp_output["interfaces"].items():
-                    port_id_dict = intf_data.get("port_id", {})
-                    for _, port_data in port_id_dict.items():
-                        for _, neighbor_info in port_data.get("neighbors", {}).items():
-                            lldp_neighbors.append({
-                                "protocol": "lldp",
-                                "local_interface": local_intf,
-                                "remote_device": neighbor_info.get("system_name") or neighbor_info.get("neighbor_id"),
-                                "remote_interface": neighbor_info.get("port_id") or neighbor_info.get("port_description"),
-                                "management_address": neighbor_info.get("management_address", "unknown"),
-                                "platform": neighbor_info.get("system_description", "").split("\n")[0]
-                            })
-        except SchemaEmptyParserError:
-            pass
-        except Exception as e:
-            print(f"[WARN] LLDP parsing failed: {e}")
+        async def _do_lldp():
+            neighbors = []
+            try:
+                lldp_output = await cached_parse(device_name, device, SHOW_LLDP)
+                neighbors = [
+                    {
+                        "protocol": "lldp",
+                        "local_interface": local_intf,
+                        "remote_device": neighbor_info.get("system_name") or neighbor_info.get("neighbor_id"),
+                        "remote_interface": neighbor_info.get("port_id") or neighbor_info.get("port_description"),
+                        "management_address": neighbor_info.get("management_address", "unknown"),
+                        "platform": neighbor_info.get("system_description", "").split("\n")[0]
+                    }
+                    for local_intf, neighbor_info in _iter_lldp(lldp_output)
+                ]
+            except SchemaEmptyParserError:
+                pass
+            except Exception as e:
+                log.warning("LLDP parsing failed on %s: %s", device_name, e)
+            await _report("lldp", neighbors)
+            return neighbors
 
         # CDP parsing
-        try:
-            cdp_output = await run_in_thread(device.parse, "show cdp neighbors detail")
-            if "index" in cdp_output:
-                for _, entry in cdp_output["index"].items():
-                    mgmt_ips = list(entry.get("management_addresses", {}).keys())
-                    cdp_neighbors.append({
-                        "protocol": "cdp",
-                        "local_interface": entry.get("local_interface"),
-                        "remote_device": entry.get("device_id"),
-                        "remote_interface": entry.get("port_id"),
-                        "management_address": mgmt_ips[0] if mgmt_ips else "unknown",
-                        "platform": entry.get("platform", "").strip()
-                    })
-        except SchemaEmptyParserError:
-            pass
-        except Exception as e:
-            print(f"[WARN] CDP parsing failed: {e}")
+        async def _do_cdp():
+            neighbors = []
+            try:
+                cdp_output = await cached_parse(device_name, device, SHOW_CDP)
+                if "index" in cdp_output:
+                    for _, entry in cdp_output["index"].items():
+                        mgmt_ips = list(entry.get("management_addresses", {}).keys())
+                        neighbors.append({
+                            "protocol": "cdp",
+                            "local_interface": entry.get("local_interface"),
+                            "remote_device": entry.get("device_id"),
+                            "remote_interface": entry.get("port_id"),
+                            "management_address": mgmt_ips[0] if mgmt_ips else "unknown",
+                            "platform": entry.get("platform", "").strip()
+                        })
+            except SchemaEmptyParserError:
+                pass
+            except Exception as e:
+                log.warning("CDP parsing failed on %s: %s", device_name, e)
+            await _report("cdp", neighbors)
+            return neighbors
+
+        # Run both discovery commands concurrently
+        lldp_neighbors, cdp_neighbors = await asyncio.gather(_do_lldp(), _do_cdp())
 
         # Combine + deduplicate neighbors
-        combined = lldp_neighbors + cdp_neighbors
-        unique_set = set()
-        deduped = []
-
-        for neighbor in combined:
-            key = (
-                neighbor["local_interface"],
-                neighbor["remote_device"],
-                neighbor["remote_interface"]
+        # (first occurrence wins, so LLDP entries take precedence over CDP)
+        unique = {}
+        for neighbor in lldp_neighbors + cdp_neighbors:
+            unique.setdefault(
+                (neighbor["local_interface"], neighbor["remote_device"], neighbor["remote_interface"]),
+                neighbor
             )
-            if key not in unique_set:
-                unique_set.add(key)
-                deduped.append(neighbor)
+        deduped = list(unique.values())
 
         return {
             "success": True,
@@ -353,11 +536,73 @@ async def discover_neighbors_combined(device_name: str = "") -> dict:
         return {"success": False, "error": str(e)}
 
 
+@mcp.tool()
+async def discover_neighbors_all(device_names: Optional[list[str]] = None) -> dict:
+    """
+    🎯 Purpose:
+        Discover LLDP and CDP neighbors of several devices in a single call.
+        Devices are queried concurrently, so this is much faster than calling
+        discover_neighbors_combined once per device.
 
-if __name__ == "__main__":
+    📥 Parameters:
+        device_names (list[str], optional): Names of devices in the pyATS testbed.
+            Defaults to every device in the testbed.
+
+    📤 Returns:
+        dict: {
+            "success": true,
+            "per_device": {
+                "<device_name>": { <discover_neighbors_combined result> },
+                ...
+            }
+        }
+
+    🧪 Example Input:
+        {
+            "device_names": ["rtr1", "rtr2"]
+        }
+    """
+    names = device_names or list(testbed.devices.keys())
+    results = await asyncio.gather(
+        *(discover_neighbors_combined(name) for name in names),
+        return_exceptions=True
+    )
+
+    per_device = {}
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            result = {"success": False, "error": str(result)}
+        per_device[name] = result
+
+    return {"success": True, "per_device": per_device}
+
+
+
+async def main():
+    # Log to stderr; in Stdio mode stdout carries the MCP protocol itself
+    logging.basicConfig(
+        level=os.getenv("MCP_LOG_LEVEL", "WARNING").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+
+    # Size the default executor so connection handshakes and health checks,
+    # which bypass the parse semaphore, don't queue behind running parses
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="pyats")
+    )
+
+    # Evict dead and idle device connections in the background
+    reaper = asyncio.create_task(connection_manager.reaper())
 
     # Run MCP server in Stdio mode
-    asyncio.run(mcp.run_stdio_async())
+    await mcp.run_stdio_async()
 
     ## Run MCP Server in SSE mode
-    #asyncio.run(mcp.run_sse_async())
+    #await mcp.run_sse_async()
+
+    reaper.cancel()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())